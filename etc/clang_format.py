@@ -10,24 +10,36 @@ A script that provides:
 from __future__ import print_function, absolute_import
 
 import Queue
+import collections
+import contextlib
 import difflib
+import fnmatch
 import glob as _glob
 import itertools
+import mmap
 import os
 import os.path
 import re
 import shutil
+import stat
 import string
 import subprocess
 import sys
-import tarfile
-import tempfile
 import threading
-import time
-import urllib
+import urllib2
 from distutils import spawn
 from optparse import OptionParser
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, TimeoutError
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        # Backport of os.scandir for Python 2, https://pypi.python.org/pypi/scandir
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 
 ##############################################################################
@@ -52,6 +64,15 @@ CLANG_FORMAT_SOURCE_URL_BASE = string.Template("http://llvm.org/releases/$versio
 # Path in the tarball to the clang-format binary
 CLANG_FORMAT_SOURCE_TAR_BASE = string.Template("clang+llvm-$version-$tar_path/bin/" + CLANG_FORMAT_PROGNAME)
 
+# Size of the buffer used when downloading and extracting the clang-format tarball
+TAR_BUFFER_SIZE = 2 * 1024 * 1024
+
+# Size of the chunks of clang-format output compared against the original file
+LINT_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of files to pass to a single clang-format -i invocation
+CLANG_FORMAT_BATCH_SIZE = 50
+
 # Copied from python 2.7 version of subprocess.py
 # Exception classes used by this module.
 class CalledProcessError(Exception):
@@ -129,29 +150,92 @@ def iglob(globbed_pathname):
             yield os.path.normpath(pathname)
         return
 
-    # **, **/, or **/a
-    if index == 0:
-        expand = _expand_curdir
-
-    # a/** or a/**/ or a/**/b
-    else:
-        expand = _expand
-
     prefix_parts = parts[:index]
     suffix_parts = parts[index + 1:]
 
-    prefix = os.path.join(*prefix_parts) if prefix_parts else os.curdir
+    # **, **/, or **/a are relative to the current directory, and the returned
+    # pathnames omit a "./" prefix
+    prefix = os.path.join(*prefix_parts) if prefix_parts else ""
     suffix = os.path.join(*suffix_parts) if suffix_parts else ""
 
-    for (kind, path) in expand(prefix):
-        if not suffix_parts:
-            yield path
+    if not os.path.isdir(prefix or os.curdir):
+        return
+
+    # a/** or **
+    if not suffix_parts:
+        # Zero expansion
+        if not prefix or os.path.basename(prefix):
+            yield os.path.join(prefix, "")
+
+        for (kind, path) in _walk(prefix):
+            yield os.path.join(path, "") if kind == "dir" else path
+        return
+
+    # a/**/b where b is a single pathname component, which can be matched against
+    # the name of every entry found while walking a/
+    if len(suffix_parts) == 1 and suffix:
+        for pathname in _match_walk(prefix, [suffix]):
+            yield pathname
+        return
+
+    # a/**/ or a/**/b/c or a/**/b/**/c, expand the suffix in every directory
+    # Zero expansion
+    dirs = itertools.chain([prefix], (path for (kind, path) in _walk(prefix) if kind == "dir"))
+
+    for path in dirs:
+        for pathname in iglob(os.path.join(path, suffix)):
+            yield pathname
+
+
+def iglob_many(globbed_pathnames):
+    """
+    Emit a list of pathnames matching any of the 'globbed_pathnames' patterns.
+
+    Patterns of the form a/**/b, where b is a single pathname component, are
+    grouped by a/ so that each directory tree is only walked once.
+    """
+
+    patterns_by_prefix = collections.OrderedDict()
 
-        # Avoid following symlinks to avoid an infinite loop
-        elif suffix_parts and kind == "dir" and not os.path.islink(path):
-            path = os.path.join(path, suffix)
-            for pathname in iglob(path):
+    for globbed_pathname in globbed_pathnames:
+        parts = _split_path(globbed_pathname)
+        parts = _canonicalize(parts)
+
+        index = _find_globstar(parts)
+        if index == -1 or len(parts) != index + 2 or not parts[-1]:
+            for pathname in iglob(globbed_pathname):
                 yield pathname
+            continue
+
+        prefix = os.path.normpath(os.path.join(*parts[:index])) if index else ""
+        patterns_by_prefix.setdefault(prefix, []).append(parts[-1])
+
+    for (prefix, patterns) in patterns_by_prefix.items():
+        for pathname in _match_walk(prefix, patterns):
+            yield pathname
+
+
+def _match_walk(prefix, patterns):
+    """
+    Emit the pathnames of all directories and files contained within the
+    'prefix' directory whose names match any of the fnmatch 'patterns'.
+    """
+
+    def compile_patterns(patterns):
+        regex = "|".join("(?:%s)" % fnmatch.translate(os.path.normcase(p)) for p in patterns)
+        return re.compile(regex).match
+
+    match_any = compile_patterns(patterns)
+
+    # Like glob, only match hidden files if the pattern asks for them
+    hidden_patterns = [p for p in patterns if p.startswith(".")]
+    match_hidden = compile_patterns(hidden_patterns) if hidden_patterns else None
+
+    for (_kind, path) in _walk(prefix):
+        name = os.path.normcase(os.path.basename(path))
+        match = match_hidden if name.startswith(".") else match_any
+        if match and match(name):
+            yield os.path.normpath(path)
 
 
 def _split_path(pathname):
@@ -213,68 +297,48 @@ def _find_globstar(parts):
 
 def _list_dir(pathname):
     """
-    Return a pair of the subdirectory names and filenames immediately
-    contained within the 'pathname' directory.
+    Return a list of ("dir", name) and ("file", name) tuples for the entries
+    immediately contained within the 'pathname' directory. Symlinks are
+    reported as files so that they are never followed.
 
-    If 'pathname' does not exist, then None is returned.
+    If 'pathname' cannot be listed, then an empty list is returned.
     """
 
-    try:
-        (_root, dirs, files) = os.walk(pathname).next()
-        return (dirs, files)
-    except StopIteration:
-        return None  # 'pathname' directory does not exist
-
-
-def _expand(pathname):
-    """
-    Emit tuples of the form ("dir", dirname) and ("file", filename)
-    of all directories and files contained within the 'pathname' directory.
-    """
+    if _scandir is None:
+        for (_root, dirs, files) in os.walk(pathname):
+            return ([("file" if os.path.islink(os.path.join(pathname, d)) else "dir", d)
+                        for d in dirs] +
+                    [("file", f) for f in files])
+        return []
 
-    res = _list_dir(pathname)
-    if res is None:
-        return
-
-    (dirs, files) = res
-
-    # Zero expansion
-    if os.path.basename(pathname):
-        yield ("dir", os.path.join(pathname, ""))
-
-    for f in files:
-        path = os.path.join(pathname, f)
-        yield ("file", path)
-
-    for d in dirs:
-        path = os.path.join(pathname, d)
-        for x in _expand(path):
-            yield x
+    # scandir caches the file type of each entry, so this does not stat every file
+    try:
+        return [("dir" if entry.is_dir(follow_symlinks=False) else "file", entry.name)
+                for entry in _scandir(pathname)]
+    except OSError:
+        return []
 
 
-def _expand_curdir(pathname):
+def _walk(top):
     """
     Emit tuples of the form ("dir", dirname) and ("file", filename)
-    of all directories and files contained within the 'pathname' directory.
+    of all directories and files contained within the 'top' directory.
 
-    The returned pathnames omit a "./" prefix.
+    An empty 'top' walks the current directory, and the returned pathnames
+    omit a "./" prefix.
     """
 
-    res = _list_dir(pathname)
-    if res is None:
-        return
+    pending = collections.deque([top])
 
-    (dirs, files) = res
-
-    # Zero expansion
-    yield ("dir", "")
+    while pending:
+        dirname = pending.popleft()
 
-    for f in files:
-        yield ("file", f)
+        for (kind, name) in _list_dir(dirname or os.curdir):
+            path = os.path.join(dirname, name)
+            yield (kind, path)
 
-    for d in dirs:
-        for x in _expand(d):
-            yield x
+            if kind == "dir":
+                pending.append(path)
 
 def get_llvm_url(version, llvm_distro):
     """Get the url to download clang-format from llvm.org
@@ -290,19 +354,98 @@ def get_tar_path(version, tar_path):
         version=version,
         tar_path=tar_path)
 
-def extract_clang_format(tar_path):
-    # Extract just the clang-format binary
-    # On OSX, we shell out to tar because tarfile doesn't support xz compression
-    if sys.platform == 'darwin':
-         subprocess.call(['tar', '-xzf', tar_path, '*clang-format*'])
-    # Otherwise we use tarfile because some versions of tar don't support wildcards without
-    # a special flag
-    else:
-        tarfp = tarfile.open(tar_path)
-        for name in tarfp.getnames():
-            if name.endswith('clang-format'):
-                tarfp.extract(name)
-        tarfp.close()
+def extract_clang_format(tar_stream, tar_copy=None):
+    """Extract just the clang-format binary from a tarball read from a file-like object,
+    optionally saving a copy of the tarball to tar_copy as it is read
+    """
+    # We shell out to tar since it is much faster than tarfile, and tarfile doesn't support
+    # xz compression
+    tar_args = ['tar', '-xzf', '-', '*clang-format*']
+
+    # GNU tar needs a special flag to support wildcards, OSX's bsdtar does not
+    if sys.platform.startswith("linux"):
+        tar_args.insert(1, '--wildcards')
+
+    tar = subprocess.Popen(tar_args, stdin=subprocess.PIPE)
+    try:
+        while True:
+            chunk = tar_stream.read(TAR_BUFFER_SIZE)
+            if not chunk:
+                break
+
+            tar.stdin.write(chunk)
+
+            if tar_copy is not None:
+                tar_copy.write(chunk)
+    finally:
+        tar.stdin.close()
+        if tar.wait():
+            raise CalledProcessError(tar.returncode, tar_args)
+
+def keep_llvm_tarball():
+    """Check whether the user asked to keep the large LLVM tarball around by setting
+    MONGO_CLANG_FORMAT_KEEP_TARBALL=1
+    """
+    return os.environ.get("MONGO_CLANG_FORMAT_KEEP_TARBALL", "0").lower() not in \
+            ("", "0", "false", "no", "off")
+
+def download_clang_format(url, cache_dir, keep_tarball):
+    """Download a tarball and extract clang-format from it
+
+    If keep_tarball is set, a copy of the tarball and its ETag are kept in cache_dir
+    so that the download can be skipped next time if the tarball has not changed.
+    """
+    if not keep_tarball:
+        print("Downloading clang-format %s from %s" % (CLANG_FORMAT_VERSION, url))
+
+        # Extract the tarball as it is downloaded instead of saving it to disk first
+        with contextlib.closing(urllib2.urlopen(url)) as response:
+            extract_clang_format(response)
+        return
+
+    tar_file = os.path.join(cache_dir, os.path.basename(url))
+    etag_file = tar_file + ".etag"
+
+    request = urllib2.Request(url)
+
+    if os.path.isfile(tar_file) and os.path.isfile(etag_file):
+        with open(etag_file) as etag:
+            request.add_header("If-None-Match", etag.read().strip())
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as err:
+        if err.code != 304:
+            raise
+
+        # Not Modified, so the copy we have is still current
+        print("Using clang-format %s from %s" % (CLANG_FORMAT_VERSION, tar_file))
+
+        try:
+            with open(tar_file, "rb") as tar_stream:
+                extract_clang_format(tar_stream)
+        except:
+            # Make sure we download the tarball again next time
+            os.remove(etag_file)
+            raise
+        return
+
+    print("Downloading clang-format %s from %s" % (CLANG_FORMAT_VERSION, url))
+
+    # The ETag is only valid once the copy of the tarball is complete
+    if os.path.isfile(etag_file):
+        os.remove(etag_file)
+
+    # Extract the tarball as it is downloaded, and save a copy of it for next time
+    with contextlib.closing(response):
+        with open(tar_file, "wb") as tar_copy:
+            extract_clang_format(response, tar_copy)
+
+        etag = response.info().getheader("ETag")
+
+    if etag:
+        with open(etag_file, "w") as etag_copy:
+            etag_copy.write(etag)
 
 def get_clang_format_from_llvm(llvm_distro, tar_path, dest_file):
     """Download clang-format from llvm.org, unpack the tarball,
@@ -311,15 +454,8 @@ def get_clang_format_from_llvm(llvm_distro, tar_path, dest_file):
     # Build URL
     url = get_llvm_url(CLANG_FORMAT_VERSION, llvm_distro)
 
-    dest_dir = tempfile.gettempdir()
-    temp_tar_file = os.path.join(dest_dir, "temp.tar.xz")
-
-    # Download from LLVM
-    print("Downloading clang-format %s from %s, saving to %s" % (CLANG_FORMAT_VERSION,
-            url, temp_tar_file))
-    urllib.urlretrieve(url, temp_tar_file)
-
-    extract_clang_format(temp_tar_file)
+    # Download from LLVM, the tarball is large so it is only kept if the user asks for it
+    download_clang_format(url, os.path.dirname(dest_file), keep_llvm_tarball())
 
     # Destination Path
     shutil.move(get_tar_path(CLANG_FORMAT_VERSION, tar_path), dest_file)
@@ -330,15 +466,8 @@ def get_clang_format_from_linux_cache(dest_file):
     # Get URL
     url = CLANG_FORMAT_HTTP_LINUX_CACHE
 
-    dest_dir = tempfile.gettempdir()
-    temp_tar_file = os.path.join(dest_dir, "temp.tar.xz")
-
-    # Download the file
-    print("Downloading clang-format %s from %s, saving to %s" % (CLANG_FORMAT_VERSION,
-            url, temp_tar_file))
-    urllib.urlretrieve(url, temp_tar_file)
-
-    extract_clang_format(temp_tar_file)
+    # Download the file, keeping the small tarball so it can be revalidated next time
+    download_clang_format(url, os.path.dirname(dest_file), keep_tarball=True)
 
     # Destination Path
     shutil.move("llvm/Release/bin/clang-format", dest_file)
@@ -373,6 +502,9 @@ class ClangFormat(object):
 
         self.path = None
 
+        # Output of clang-format --version for each path we have tried
+        self.versions = {}
+
         # Find Clang-Format now
         if path is not None:
             if os.path.isfile(path):
@@ -419,15 +551,52 @@ class ClangFormat(object):
         # Validate we have the correct version
         self._validate_version()
 
-        self.print_lock = threading.Lock()
+        # Use diff to print diffs where available since difflib is slow on large files
+        self.diff_path = spawn.find_executable("diff")
+
+        # Diffs are written to the screen by a single thread so that they do not get mixed,
+        # and workers never have to wait for another worker's diff to be printed
+        self.print_queue = Queue.Queue()
+
+        self.printer = threading.Thread(target=self._printer)
+        self.printer.daemon = True
+        self.printer.start()
+
+    def _printer(self):
+        """Printer thread to write queued messages to the screen
+        """
+        while True:
+            message = self.print_queue.get()
+            if message is None:
+                return
+
+            sys.stdout.write(message)
+            sys.stdout.flush()
+
+    def close(self):
+        """Wait for all the queued messages to be printed
+        """
+        self.print_queue.put(None)
+        self.printer.join()
+
+    def _get_version(self):
+        """Get the version of clang-format, only calling it once for each path
+        """
+        if self.path not in self.versions:
+            try:
+                self.versions[self.path] = callo([self.path, "--version"])
+            except CalledProcessError:
+                self.versions[self.path] = "clang-format call failed."
+
+        return self.versions[self.path]
 
     def _validate_version(self, warn=False):
         """Validate clang-format is the expected version
         """
-        try:
-            cf_version = callo([self.path, "--version"])
-        except CalledProcessError:
-            cf_version = "clang-format call failed."
+        cf_version = self._get_version()
+
+        if CLANG_FORMAT_VERSION in cf_version:
+            return True
 
         if warn:
             print("WARNING: clang-format found in path, but incorrect version found at " +
@@ -435,134 +604,220 @@ class ClangFormat(object):
 
         return False
 
+    def _get_formatted_file(self, file_name, original_file, keep_output):
+        """Compare the original file against clang-format's output as it is produced
+
+        Returns whether the file is correctly formatted, and when it is not, the formatted
+        file if keep_output is set.
+        """
+        args = [self.path, "--style=file", file_name]
+        clang_format = subprocess.Popen(args, stdout=subprocess.PIPE)
+
+        formatted_chunks = []
+        offset = 0
+        clean = True
+
+        while True:
+            chunk = clang_format.stdout.read(LINT_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            if clean and original_file[offset:offset + len(chunk)] != chunk:
+                clean = False
+
+                # Stop at the first difference unless we need the rest of the output
+                if not keep_output:
+                    clang_format.kill()
+                    clang_format.stdout.close()
+                    clang_format.wait()
+                    return (False, None)
+
+            if keep_output:
+                formatted_chunks.append(chunk)
+
+            offset += len(chunk)
+
+        clang_format.stdout.close()
+        if clang_format.wait():
+            raise CalledProcessError(clang_format.returncode, args)
+
+        if clean and offset == len(original_file):
+            return (True, None)
+
+        return (False, "".join(formatted_chunks) if keep_output else None)
+
     def _lint(self, file_name, print_diff):
         """Check the specified file has the correct format
         """
         with open(file_name, 'rb') as original_text:
-            original_file = original_text.read()
+            # Map the file rather than reading it, most of a dirty file never needs to be
+            # looked at. Empty files cannot be mapped.
+            if os.fstat(original_text.fileno()).st_size:
+                original_file = mmap.mmap(original_text.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                original_file = ""
+
+            try:
+                (clean, formatted_file) = self._get_formatted_file(file_name, original_file,
+                        keep_output=print_diff)
 
-        # Get formatted file as clang-format would format the file
-        formatted_file = callo([self.path, "--style=file", file_name])
+                if not clean and print_diff:
+                    result = self._diff(file_name, original_file, formatted_file)
+            finally:
+                if isinstance(original_file, mmap.mmap):
+                    original_file.close()
 
-        if original_file != formatted_file:
+        if not clean:
             if print_diff:
-                original_lines = original_file.splitlines()
-                formatted_lines = formatted_file.splitlines()
-                result = difflib.unified_diff(original_lines, formatted_lines)
-
-                # Take a lock to ensure diffs do not get mixed when printed to the screen
-                with self.print_lock:
-                    print("ERROR: Found diff for " + file_name)
-                    print("To fix formatting errors, run %s --style=file -i %s" %
-                            (self.path, file_name))
-                    for line in result:
-                        print(line.rstrip())
+                # Queue the whole diff as one message to ensure diffs do not get mixed
+                lines = ["ERROR: Found diff for " + file_name,
+                        "To fix formatting errors, run %s --style=file -i %s" %
+                            (self.path, file_name)]
+                lines += [line.rstrip() for line in result]
+
+                self.print_queue.put("\n".join(lines) + "\n")
 
             return False
 
         return True
 
+    def _diff(self, file_name, original_file, formatted_file):
+        """Get the lines of a unified diff between the specified file and its formatted version
+        """
+        if self.diff_path:
+            # Diff the file on disk against the formatted file on stdin
+            diff = subprocess.Popen([self.diff_path, "-u", file_name, "-"],
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output = diff.communicate(formatted_file)[0]
+
+            # diff returns 1 when the files differ, and 2 if it had trouble
+            if diff.returncode in (0, 1):
+                return output.splitlines()
+
+        # The original file may be a memory map, so copy it out before splitting it
+        return list(difflib.unified_diff(original_file[:].splitlines(),
+                    formatted_file.splitlines()))
+
     def lint(self, file_name):
         """Check the specified file has the correct format
         """
         return self._lint(file_name, print_diff=True)
 
-    def format(self, file_name):
-        """Update the format of the specified file
+    def format(self, file_names):
+        """Update the format of the specified batch of files
         """
-        if self._lint(file_name, print_diff=False):
+        # Only rewrite the files which need it
+        dirty_files = [f for f in file_names if not self._lint(f, print_diff=False)]
+
+        if not dirty_files:
             return True
 
-        # Update the file with clang-format
-        return not subprocess.call([self.path, "--style=file", "-i", file_name])
+        # Update all the files with a single call to clang-format
+        return not subprocess.call([self.path, "--style=file", "-i"] + dirty_files)
 
 
-def parallel_process(items, func):
-    """Run a set of work items to completion
+def get_cpu_count():
+    """Get the number of cpus to use for parallel work
     """
     try:
-        cpus = cpu_count()
+        return cpu_count()
     except NotImplementedError:
-        cpus = 1
+        return 1
 
-    task_queue = Queue.Queue()
 
-    # Use a list so that worker function will capture this variable
+def parallel_process(items, func):
+    """Run a set of work items to completion
+    """
+    # Skip starting any threads when there is nothing to run in parallel
+    if len(items) <= 1:
+        return all(func(item) for item in items)
+
+    # There is no point in starting more threads than there are items, which matters
+    # for lint-patch where there are only a handful of files
+    cpus = min(get_cpu_count(), len(items))
+
+    # Hand out several items at a time when there are many of them to cut down on
+    # scheduling overhead, using the same heuristic as Pool.map
+    # Note: The chunks are built here rather than passing a chunksize to imap_unordered,
+    #  because on Python 2 that returns a generator which does not support a timeout
+    chunksize = max(1, len(items) // (cpus * 4))
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+
+    # Set when we stop early so that the workers do not start any more work items
     pp_event = threading.Event()
-    pp_result = [True]
-    pp_lock = threading.Lock()
 
-    def worker():
-        """Worker thread to process work items in parallel
+    def process_chunk(chunk):
+        """Process a chunk of work items, stopping at the first failure
         """
-        while not pp_event.is_set():
-            try:
-                item = task_queue.get_nowait()
-            except Queue.Empty:
-                # if the queue is empty, exit the worker thread
-                pp_event.set()
-                return
-
-            try:
-                ret = func(item)
-            finally:
-                # Tell the queue we finished with the item
-                task_queue.task_done()
-
-            # Return early if we fail, and signal we are done
-            if not ret:
-                with pp_lock:
-                    pp_result[0] = False
+        for item in chunk:
+            if pp_event.is_set() or not func(item):
+                return False
 
-                pp_event.set()
-                return
-
-    # Enqueue all the work we want to process
-    for item in items:
-        task_queue.put(item)
+        return True
 
-    # Process all the work
-    threads = []
-    for cpu in range(cpus):
-        thread = threading.Thread(target=worker)
+    pool = ThreadPool(cpus)
 
-        thread.daemon = True
-        thread.start()
-        threads.append(thread)
+    try:
+        results = pool.imap_unordered(process_chunk, chunks)
 
-    # Wait for the threads to finish
-    # Loop with a timeout so that we can process Ctrl-C interrupts
-    # Note: On Python 2.6 wait always returns None so we check is_set also,
-    #  This works because we only set the event once, and never reset it
-    while not pp_event.wait(1) and not pp_event.is_set():
-        time.sleep(1)
+        while True:
+            # Wait with a timeout so that we can process Ctrl-C interrupts
+            # Note: On Python 2 waiting without a timeout cannot be interrupted
+            try:
+                ret = results.next(1)
+            except TimeoutError:
+                continue
+            except StopIteration:
+                return True
 
-    for thread in threads:
-        thread.join()
+            # Return early if we fail, terminate stops the remaining work items
+            if not ret:
+                return False
+    finally:
+        pp_event.set()
+        pool.terminate()
+        pool.join()
 
-    return pp_result[0]
+# Cached result of get_base_dir so git is only invoked once per run
+_base_dir_cache = None
 
 def get_base_dir():
     """Get the base directory for mongo repo.
         This script assumes that it is running in buildscripts/, and uses
         that to find the base directory.
     """
-    try:
-        return subprocess.check_output(['git', 'rev-parse', '--show-toplevel']).rstrip()
-    except:
-        # We are not in a valid git directory. Use the script path instead.
-        return os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    global _base_dir_cache
+
+    if _base_dir_cache is None:
+        try:
+            _base_dir_cache = subprocess.check_output(['git', 'rev-parse', '--show-toplevel']).rstrip()
+        except:
+            # We are not in a valid git directory. Use the script path instead.
+            _base_dir_cache = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+    return _base_dir_cache
+
+# Cached result of get_repos so each repository is only queried once per run
+_repos_cache = None
 
 def get_repos():
     """Get a list of Repos to check clang-format for
     """
-    base_dir = get_base_dir()
+    global _repos_cache
+
+    if _repos_cache is None:
+        base_dir = get_base_dir()
+
+        paths = [base_dir]
 
-    paths = [base_dir]
+        _repos_cache = [Repo(p) for p in paths]
 
-    return [Repo(p) for p in paths]
+    return _repos_cache
 
 
+# Extensions of the files in a repository to run clang-format on
+_CXX_EXT_RE = re.compile(r"\.(h|hpp|cpp)$")
+
 class Repo(object):
     """Class encapsulates all knowledge about a git repository, and its metadata
         to run clang-format.
@@ -570,25 +825,25 @@ class Repo(object):
     def __init__(self, path):
         self.path = path
 
-       # Get candidate files
-        self.candidate_files = self._get_candidate_files()
+        # The repository path is the git root, so there is no need to ask git for it
+        self.root = os.path.abspath(path)
 
-        self.root = self._get_root()
+        # Get candidate files, as a set since they are only used for intersections
+        self.candidate_files = frozenset(self._get_candidate_files())
 
     def _callgito(self, args):
         """Call git for this repository
         """
-        # These two flags are the equivalent of -C in newer versions of Git
-        # but we use these to support versions back to ~1.8
-        return callo(['git', '--git-dir', os.path.join(self.path, ".git"),
-                        '--work-tree', self.path] + args)
+        # Running git from the repository is the equivalent of -C in newer versions of Git
+        # but we use this to support versions back to ~1.8
+        return check_output(['git'] + args, cwd=self.path, close_fds=False)
 
     def _get_local_dir(self, path):
         """Get a directory path relative to the git root directory
         """
-        if os.path.isabs(path):
-            return os.path.relpath(path, self.root)
-        return path
+        if not os.path.isabs(path):
+            return path
+        return os.path.relpath(path, self.root)
 
     def get_candidates(self, candidates):
         """Get the set of candidate files to check by doing an intersection
@@ -600,9 +855,9 @@ class Repo(object):
 
         if candidates is not None and len(candidates) > 0:
             candidates = [self._get_local_dir(f) for f in candidates]
-            valid_files = list(set(candidates).intersection(self.get_candidate_files()))
+            valid_files = list(self.candidate_files.intersection(candidates))
         else:
-            valid_files = list(self.get_candidate_files())
+            valid_files = list(self.candidate_files)
 
         # Get the full file name here
         valid_files = [os.path.normpath(os.path.join(self.root, f)) for f in valid_files]
@@ -613,50 +868,43 @@ class Repo(object):
         """
         return self.root
 
-    def _get_root(self):
-        """Gets the root directory for this repository from git
-        """
-        gito = self._callgito(['rev-parse', '--show-toplevel'])
-
-        return gito.rstrip()
-
     def get_candidate_files(self):
-        """Get a list of candidate files
+        """Get the set of candidate files
         """
-        return self._get_candidate_files()
+        return self.candidate_files
 
     def _get_candidate_files(self):
         """Query git to get a list of all files in the repo to consider for analysis
         """
-        gito = self._callgito(["ls-files"])
+        # Use NUL delimited output so file names are passed through verbatim, and
+        # --full-name so the names are relative to the root regardless of the cwd
+        gito = self._callgito(["ls-files", "-z", "--full-name"])
 
         # This allows us to pick all the interesting files
         # in the mongo and mongo-enterprise repos
-        file_list = [line.rstrip()
-                for line in gito.splitlines() if "src" in line and
-                    not "examples" in line and
-                    not "third_party" in line]
-
-        files_match = re.compile('\\.(h|hpp|cpp)$')
-
-        file_list = [a for a in file_list if files_match.search(a)]
+        # Filter in a single pass, with the cheap substring tests ahead of the regex
+        file_list = [line
+                for line in gito.split("\0") if "src" in line and
+                    "examples" not in line and
+                    "third_party" not in line and
+                    _CXX_EXT_RE.search(line)]
 
         return file_list
 
 
-def expand_file_string(glob_pattern):
-    """Expand a string that represents a set of files
+def expand_file_strings(glob_patterns):
+    """Expand a list of strings that each represent a set of files
     """
-    return [os.path.abspath(f) for f in iglob(glob_pattern)]
+    return [os.path.abspath(f) for f in iglob_many(glob_patterns)]
 
 def get_files_to_check(files):
     """Filter the specified list of files to check down to the actual
         list of files that need to be checked."""
     candidates = []
 
-    # Get a list of candidate_files
-    candidates = [expand_file_string(f) for f in files]
-    candidates = list(itertools.chain.from_iterable(candidates))
+    # Get a list of candidate_files, expanding all the patterns together so that patterns
+    # which share a directory only walk it once
+    candidates = expand_file_strings(files)
 
     repos = get_repos()
 
@@ -664,20 +912,36 @@ def get_files_to_check(files):
 
     return valid_files
 
+# Matches the name of each file changed in a patch generated by git diff
+_PATCH_FILE_RE = re.compile(r"^diff --git a/(\S+) b/", re.MULTILINE)
+
 def get_files_to_check_from_patch(patches):
     """Take a patch file generated by git diff, and scan the patch for a list of files to check.
     """
     candidates = []
 
-    # Get a list of candidate_files
-    check = re.compile(r"^diff --git a\/([a-z\/\.\-_0-9]+) b\/[a-z\/\.\-_0-9]+")
-
-    lines = []
+    # Get a list of candidate_files, scanning the memory mapped patch instead of
+    # splitting it into lines
     for patch in patches:
         with open(patch, "rb") as infile:
-            lines += infile.readlines()
+            patch_stat = os.fstat(infile.fileno())
+
+            # Only regular files can be mapped, so read anything else such as a pipe
+            # from /dev/stdin, which always reports a size of 0
+            if not stat.S_ISREG(patch_stat.st_mode):
+                candidates.extend(match.group(1)
+                        for match in _PATCH_FILE_RE.finditer(infile.read()))
+                continue
+
+            # Empty files cannot be mapped
+            if not patch_stat.st_size:
+                continue
 
-    candidates = [check.match(line).group(1) for line in lines if check.match(line)]
+            patch_map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                candidates.extend(match.group(1) for match in _PATCH_FILE_RE.finditer(patch_map))
+            finally:
+                patch_map.close()
 
     repos = get_repos()
 
@@ -695,7 +959,10 @@ def _lint_files(clang_format, files):
     """
     clang_format = ClangFormat(clang_format, _get_build_dir())
 
-    lint_clean = parallel_process([os.path.abspath(f) for f in files], clang_format.lint)
+    try:
+        lint_clean = parallel_process([os.path.abspath(f) for f in files], clang_format.lint)
+    finally:
+        clang_format.close()
 
     if not lint_clean:
         print("ERROR: Code Style does not match coding style")
@@ -724,7 +991,17 @@ def _format_files(clang_format, files):
     """
     clang_format = ClangFormat(clang_format, _get_build_dir())
 
-    format_clean = parallel_process([os.path.abspath(f) for f in files], clang_format.format)
+    files = [os.path.abspath(f) for f in files]
+
+    # Batch the files to cut down on clang-format invocations, but keep the batches
+    # small enough that every cpu still gets some work
+    batch_size = max(1, min(CLANG_FORMAT_BATCH_SIZE, len(files) // get_cpu_count()))
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+
+    try:
+        format_clean = parallel_process(batches, clang_format.format)
+    finally:
+        clang_format.close()
 
     if not format_clean:
         print("ERROR: failed to format files")
@@ -742,6 +1019,9 @@ def usage():
     """
     print("clang-format.py supports 3 commands [ lint, lint-patch, format ]. Run "
             " <command> -? for more information")
+    print("Set MONGO_CLANG_FORMAT to the clang-format binary to use, and set "
+            "MONGO_CLANG_FORMAT_KEEP_TARBALL=1 to keep the LLVM tarball downloaded on OSX so "
+            "that it is only downloaded again if it changes")
 
 def main():
     """Main entry point